@@ -5,37 +5,108 @@ Before running this app, set the following environment variables:
 
 DB_URL: postgres DB connection string (required)
 DATA_URL: of generation JSON data (optional)
+SENTRY_DSN: to report errors to sentry (optional, sentry is not initialised without it)
+ENVIRONMENT: sentry environment name (optional, defaults to "local")
+SENTRY_TRACES_SAMPLE_RATE: fraction of runs sentry traces (optional, defaults to 0, i.e. only
+    errors are reported)
 
 """
 
+from __future__ import annotations
+
 import datetime as dt
+import functools
+import io
 import logging
 import os
 import sys
-import time
+import threading
+import uuid
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, NamedTuple
+from zoneinfo import ZoneInfo
 
 import click
-import pandas as pd
-import pytz
-import requests
-import sentry_sdk
-from pvsite_datamodel import DatabaseConnection, SiteSQL
-from pvsite_datamodel.read import get_sites_by_country
-from pvsite_datamodel.write import insert_generation_values
-from sqlalchemy.orm import Session
 
 from ruvnl_consumer_app import __version__
 
-log = logging.getLogger(__name__)
+# The heavier dependencies (pandas, requests, sqlalchemy, pvsite_datamodel, sentry) are
+# imported by the functions that use them, so that e.g. `app --help` starts quickly
+if TYPE_CHECKING:
+    import pandas as pd
+    import requests
+    from pvsite_datamodel import SiteSQL
+    from sqlalchemy.orm import Session
 
-sentry_sdk.init(
-    dsn=os.getenv("SENTRY_DSN"), environment=os.getenv("ENVIRONMENT", "local"), traces_sample_rate=1
-)
-sentry_sdk.set_tag("app_name", "india_ruvnl_consumer")
-sentry_sdk.set_tag("version", __version__)
+log = logging.getLogger(__name__)
 
 DEFAULT_DATA_URL = "http://sldc.rajasthan.gov.in/rrvpnl/read-sftp?type=overview"
 
+IST = ZoneInfo("Asia/Kolkata")
+
+# Maps the RUVNL scada_name of each generation record to its asset type
+_ASSET_MAP = {"WIND GEN": "wind", "SOLAR GEN": "pv"}
+
+MAX_RETRIES = 5
+MAX_BACKOFF = 300
+
+# Each generation value covers this interval from its start_utc, matching the end_utc written by
+# pvsite_datamodel's insert_generation_values
+GENERATION_INTERVAL = dt.timedelta(minutes=5)
+
+# Batches with at least this many rows are written with COPY rather than INSERT
+COPY_THRESHOLD = 100
+
+
+def _get_retry(backoff_factor: float):
+    """
+    Builds the retry policy used when fetching data
+
+    Args:
+            backoff_factor: the backoff factor (seconds) for the exponential backoff between
+                    retries, also used as the upper bound of the random jitter added to each wait
+
+    Returns:
+            A urllib3 Retry object
+    """
+    from urllib3.util import Retry
+
+    return Retry(
+        total=MAX_RETRIES,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_factor,
+        backoff_max=MAX_BACKOFF,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+
+
+@functools.cache
+def _get_http_session(backoff_factor: float) -> requests.Session:
+    """
+    Gets the shared HTTP session for a retry backoff factor
+
+    The session is created on first use and then reused, so the connection to the data source is
+    pooled and reused across retries. Its adapter applies the retry policy from _get_retry.
+
+    Args:
+            backoff_factor: the backoff factor (seconds) for the exponential backoff between retries
+
+    Returns:
+            A requests Session
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    retry = _get_retry(backoff_factor)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
 
 def get_sites(db_session: Session) -> list[SiteSQL]:
     """
@@ -47,92 +118,170 @@ def get_sites(db_session: Session) -> list[SiteSQL]:
     Returns:
             A list of SiteSQL objects
     """
+    from pvsite_datamodel import SiteSQL
+    from sqlalchemy.orm import load_only
+
+    asset_types = ["pv", "wind"]
+    rows = (
+        db_session.query(SiteSQL)
+        # only load the columns the app uses, the rest are loaded if accessed
+        .options(load_only(SiteSQL.site_uuid, SiteSQL.asset_type, SiteSQL.capacity_kw))
+        .filter(
+            SiteSQL.country == "india",
+            SiteSQL.region == "ruvnl",
+            SiteSQL.asset_type.in_(asset_types),
+        )
+        .order_by(SiteSQL.site_uuid)
+        .all()
+    )
+
+    # This naively selects the 1st wind and 1st pv site returned
+    sites_by_asset_type = {}
+    for site in rows:
+        sites_by_asset_type.setdefault(site.asset_type.name, site)
 
-    all_sites = get_sites_by_country(db_session, country="india")
-
-    # This naively selects the 1st wind and 1st pv site in the array
     valid_sites = []
-    for asset_type in ["pv", "wind"]:
+    for asset_type in asset_types:
+        if asset_type not in sites_by_asset_type:
+            log.warning("Could not find site for asset type: %s", asset_type)
+            assert (
+                asset_type in sites_by_asset_type
+            ), f"No sites found for ruvnl region for asset type: {asset_type}"
 
-        sites = [
-            s for s in all_sites if (s.asset_type.name == asset_type) and (s.region == "ruvnl")
-        ]
-        if len(sites) == 0:
-            log.warning(f"Could not find site for asset type: {asset_type}")
-            assert len(sites) > 0, f"No sites found for ruvnl region for asset type: {asset_type}"
-
-        valid_sites.append(sites[0])
+        valid_sites.append(sites_by_asset_type[asset_type])
 
     return valid_sites
 
 
-def fetch_data(data_url: str, retry_interval: int = 30) -> pd.DataFrame:
+class AssetRecord(NamedTuple):
+    """A validated generation record for one asset from the RUVNL feed"""
+
+    source_time_sec: int
+    power_mw: float
+
+
+def _read_asset_records(r: requests.Response) -> dict[str, AssetRecord]:
+    """
+    Streams the response JSON and picks out the generation record for each asset
+
+    Only the inner generation records are parsed, and parsing stops as soon as a valid record
+    has been found for every asset in _ASSET_MAP. Malformed records are logged and skipped.
+
+    Args:
+            r: A streamed response from the RUVNL API
+
+    Returns:
+            A dict of scada_name to generation record (the first valid one found for each)
+    """
+    import ijson
+
+    r.raw.decode_content = True
+    records = {}
+    for record in ijson.items(r.raw, "data.item.0", use_float=True):
+        scada_name = record.get("scada_name") if isinstance(record, dict) else None
+        if scada_name not in _ASSET_MAP or scada_name in records:
+            continue
+
+        try:
+            records[scada_name] = AssetRecord(
+                source_time_sec=int(record["SourceTimeSec"]),
+                power_mw=float(record["Average2"]),
+            )
+        except (KeyError, TypeError, ValueError):
+            log.warning("Ignoring malformed record for %s: %s", scada_name, record)
+            continue
+
+        if len(records) == len(_ASSET_MAP):
+            break
+
+    return records
+
+
+def fetch_data(data_url: str, retry_interval: int = 2) -> pd.DataFrame:
     """
     Fetches the latest state-wide generation data for Rajasthan
 
     Args:
             data_url: The URL to query data from
-            retry_interval: the amount of seconds to sleep between retying the api again.
+            retry_interval: the backoff factor (seconds) for the exponential backoff between
+                retrying the api again.
 
     Returns:
             A pandas DataFrame of generation values for wind and PV
 
     Raises:
             RuntimeError: If max retries are reached without any response
+            ijson.JSONError: If the response is not valid JSON
     """
+    import numpy as np
+    import pandas as pd
+    import requests
+
     print("Starting to get data")
-    retries = 0
-    max_retries = 5
-    while retries < max_retries:
-        try:
-            r = requests.get(data_url, timeout=10)  # 10 second
-            # Got a response (even if not 200), so break the retry loop
-            break
-        except requests.exceptions.Timeout as err:
-            log.error("Timed out")
-            retries += 1
-            if retries == max_retries:
-                error_msg = f"Failed to fetch data after {max_retries} attempts from {data_url}"
-                log.error(error_msg)
-                raise RuntimeError(error_msg) from err
-            log.info(f"Retrying again in {retry_interval} seconds (retry count: {retries})")
-            time.sleep(retry_interval)
-
-    # Handle non-200 status codes by returning empty DataFrame
-    if r.status_code != 200:
-        log.warning(f"Failed to fetch data from {data_url}. Status code: {r.status_code}")
-        return pd.DataFrame(columns=["asset_type", "start_utc", "power_kw"])
-
-    raw_data = r.json()
-    asset_map = {"WIND GEN": "wind", "SOLAR GEN": "pv"}
-    data = []
-    for k, v in asset_map.items():
-        record = next((d["0"] for d in raw_data["data"] if d["0"]["scada_name"] == k), None)
-        if record is not None:
-
-            start_utc = dt.datetime.fromtimestamp(int(record["SourceTimeSec"]), tz=dt.UTC)
-            power_kw = record["Average2"] * 1000  # source is in MW, convert to kW
-            if power_kw < 0:
-                log.warning(f"Ignoring negative power value: {power_kw} kW for asset type: {v}")
-                continue
-            if v == "wind":
-                if start_utc < dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=1):
-                    start_ist = start_utc.astimezone(pytz.timezone("Asia/Calcutta"))
-                    start_ist = str(start_ist)
-                    now = dt.datetime.now(pytz.timezone("Asia/Calcutta"))
-                    now = str(now)
-                    timestamp_after_raise = f"Timestamp Now: {now} Timestamp data: {start_ist}"
-                    timestamp_fstring = f"{timestamp_after_raise}"
-                    log.warning("Start time is at least 1 hour old. " + timestamp_fstring)
-
-            data.append({"asset_type": v, "start_utc": start_utc, "power_kw": power_kw})
-            log.info(
-                f"Found generation data for asset type: {v}, " f"{power_kw} kW at {start_utc} UTC"
-            )
-        else:
-            log.warning(f"No generation data for asset type: {v}")
+    # Retries (with exponential backoff) are handled by the session's adapter
+    try:
+        r = _get_http_session(retry_interval).get(data_url, timeout=10, stream=True)  # 10 second
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as err:
+        error_msg = f"Failed to fetch data after {MAX_RETRIES + 1} attempts from {data_url}"
+        log.error(error_msg)
+        raise RuntimeError(error_msg) from err
+
+    with r:
+        # Handle non-200 status codes by returning empty DataFrame
+        if r.status_code != 200:
+            log.warning("Failed to fetch data from %s. Status code: %s", data_url, r.status_code)
+            return pd.DataFrame(columns=["asset_type", "start_utc", "power_kw"])
+
+        index = _read_asset_records(r)
+
+    for k, v in _ASSET_MAP.items():
+        if k not in index:
+            log.warning("No generation data for asset type: %s", v)
+    present = [k for k in _ASSET_MAP if k in index]
+
+    # Build the frame in one go from typed arrays, rather than row by row
+    times = np.fromiter(
+        (index[k].source_time_sec for k in present), dtype="int64", count=len(present)
+    )
+    powers = np.fromiter((index[k].power_mw for k in present), dtype="float64", count=len(present))
+    data = pd.DataFrame(
+        {
+            "asset_type": [_ASSET_MAP[k] for k in present],
+            "start_utc": pd.to_datetime(times, unit="s", utc=True),
+            "power_kw": powers * 1000.0,  # source is in MW, convert to kW
+        }
+    )
+
+    # Drop any negative power values
+    negative = data["power_kw"] < 0
+    if negative.any():
+        log.warning(
+            "Ignoring %s negative power value(s): %s",
+            negative.sum(),
+            data.loc[negative, ["asset_type", "power_kw"]].to_dict("records"),
+        )
+        data = data.loc[~negative]
+
+    # Warn about old wind data
+    now_utc = dt.datetime.now(tz=dt.UTC)
+    stale_cutoff = now_utc - dt.timedelta(hours=1)
+    stale = (data["asset_type"] == "wind") & (data["start_utc"] < stale_cutoff)
+    for start_utc in data.loc[stale, "start_utc"]:
+        log.warning(
+            "Start time is at least 1 hour old. Timestamp Now: %s Timestamp data: %s",
+            now_utc.astimezone(IST),
+            start_utc.astimezone(IST),
+        )
+
+    for row in data.itertuples(index=False):
+        log.info(
+            "Found generation data for asset type: %s, %s kW at %s UTC",
+            row.asset_type,
+            row.power_kw,
+            row.start_utc,
+        )
 
-    return pd.DataFrame(data)
+    return data
 
 
 def merge_generation_data_with_sites(data: pd.DataFrame, sites: list[SiteSQL]) -> pd.DataFrame:
@@ -149,55 +298,223 @@ def merge_generation_data_with_sites(data: pd.DataFrame, sites: list[SiteSQL]) -
 
     # Associate correct site_uuid with each generation asset type
     sites_map = {s.asset_type.name: s.site_uuid for s in sites}
-    data["site_uuid"] = data["asset_type"].apply(lambda d: sites_map[d] if d in sites_map else None)
+    # assign (rather than setting a column) so the caller's frame, which may be a slice of
+    # another frame, is never written to
+    data = data.assign(site_uuid=data["asset_type"].map(sites_map))
 
-    # Remove generation data for which we have no associated site
-    data = data[data["site_uuid"].notnull()]
+    # Remove generation data for which we have no associated site (in place, as data is now
+    # our own copy)
+    data.dropna(subset=["site_uuid"], inplace=True)
 
     return data
 
 
+def insert_generation_rows(db_session: Session, generation_data: pd.DataFrame) -> None:
+    """
+    Writes generation values to the DB with a single executemany INSERT
+
+    Unlike pvsite_datamodel's insert_generation_values, this doesn't build a GenerationSQL object
+    per row. As there, rows which already exist are skipped.
+
+    Args:
+            db_session: A SQLAlchemy session
+            generation_data: a pandas Dataframe of site_uuid, start_utc and power_kw values
+    """
+    from pvsite_datamodel import GenerationSQL
+    from sqlalchemy.dialects.postgresql import insert
+
+    rows = (
+        generation_data[["site_uuid", "start_utc", "power_kw"]]
+        .rename(columns={"power_kw": "generation_power_kw"})
+        .assign(end_utc=lambda df: df["start_utc"] + GENERATION_INTERVAL)
+        .to_dict("records")
+    )
+
+    db_session.execute(insert(GenerationSQL.__table__).on_conflict_do_nothing(), rows)
+
+
+def bulk_insert_with_copy(
+    db_session: Session, table_name: str, df: pd.DataFrame, cols: list[str]
+) -> None:
+    """
+    Bulk inserts a dataframe into a table using postgres COPY ... FROM STDIN
+
+    Args:
+            db_session: A SQLAlchemy session
+            table_name: the name of the table to copy into
+            df: a pandas DataFrame containing (at least) the columns to copy
+            cols: the columns to copy, in the order they are written
+    """
+
+    buf = io.StringIO()
+    df[cols].to_csv(buf, sep="\t", header=False, index=False, na_rep="\\N")
+    buf.seek(0)
+
+    with db_session.connection().connection.cursor() as cursor:
+        cursor.copy_from(buf, table_name, columns=cols, sep="\t")
+
+
+def copy_generation_values(db_session: Session, generation_data: pd.DataFrame) -> None:
+    """
+    Writes generation values to the DB via COPY
+
+    Rows are copied into a temporary staging table and then moved into the generation table,
+    so that (like insert_generation_rows) rows which already exist are skipped.
+
+    Args:
+            db_session: A SQLAlchemy session
+            generation_data: a pandas Dataframe of site_uuid, start_utc and power_kw values
+    """
+    import pandas as pd
+    from sqlalchemy import text
+
+    start_utc = pd.to_datetime(generation_data["start_utc"], utc=True).dt.tz_convert(None)
+    rows = pd.DataFrame(
+        {
+            "generation_uuid": [uuid.uuid4() for _ in range(len(generation_data))],
+            "site_uuid": generation_data["site_uuid"].to_numpy(),
+            "generation_power_kw": generation_data["power_kw"].to_numpy(),
+            "start_utc": start_utc.to_numpy(),
+            "end_utc": (start_utc + GENERATION_INTERVAL).to_numpy(),
+            "created_utc": dt.datetime.now(tz=dt.UTC).replace(tzinfo=None),
+        }
+    )
+    cols = list(rows.columns)
+
+    db_session.execute(
+        text("CREATE TEMP TABLE generation_staging (LIKE generation INCLUDING DEFAULTS)")
+    )
+    bulk_insert_with_copy(db_session, "generation_staging", rows, cols)
+    db_session.execute(
+        text(
+            f"INSERT INTO generation ({', '.join(cols)}) "
+            f"SELECT {', '.join(cols)} FROM generation_staging ON CONFLICT DO NOTHING"
+        )
+    )
+    db_session.execute(text("DROP TABLE generation_staging"))
+
+
 def save_generation_data(
-    db_session: Session, generation_data: pd.DataFrame, write_to_db: bool
+    db_session: Session,
+    generation_data: pd.DataFrame,
+    write_to_db: bool,
+    sites: list[SiteSQL] | None = None,
 ) -> None:
     """
     Saves generation data to DB (or prints to stdout)
 
+    Nothing is committed here; the caller's transaction commits the generation values and any
+    capacity updates together.
+
     Args:
             db_session: A SQLAlchemy session
             generation_data: a pandas Dataframe of generation values for PV and wind
             write_to_db: If true, generation values are written to db, otherwise to stdout
+            sites: the SiteSQL objects (from db_session) the data is for, e.g. from get_sites.
+                If not given, they are queried from the DB.
     """
+    from pvsite_datamodel import SiteSQL
 
-    for asset_type in ["pv", "wind"]:
-        asset_data = generation_data[generation_data["asset_type"] == asset_type]
+    # Summarise the data per site (each site has a single asset type) in a single groupby
+    by_site = generation_data.groupby("site_uuid", sort=False).agg(
+        asset_type=("asset_type", "first"), max_power_kw=("power_kw", "max")
+    )
+    asset_types = set(by_site["asset_type"])
 
-        if asset_data.empty:
-            log.warning(f"No generation data for asset type: {asset_type}")
+    for asset_type in ["pv", "wind"]:
+        if asset_type not in asset_types:
+            log.warning("No generation data for asset type: %s", asset_type)
+        elif not write_to_db and log.isEnabledFor(logging.INFO):
+            asset_data = generation_data.loc[generation_data["asset_type"] == asset_type]
+            asset_data = asset_data.drop(columns="asset_type")
+            log.info("Generation data: %s:\n%s", asset_type, asset_data)
+
+    if not write_to_db or generation_data.empty:
+        return
+
+    # check if generation exceeds capacity and update if necessary. The site objects are
+    # updated in memory and flushed together with the generation values on commit. The maxima
+    # are pulled out into a plain dict so the per-site lookups avoid the pandas indexer
+    max_power_by_site = dict(
+        zip(by_site.index, by_site["max_power_kw"].to_numpy().tolist(), strict=True)
+    )
+    if sites is None:
+        sites = (
+            db_session.query(SiteSQL)
+            .filter(SiteSQL.site_uuid.in_(list(max_power_by_site)))
+            .all()
+        )
+    for site in sites:
+        max_power = max_power_by_site.get(site.site_uuid)
+        if max_power is None:
             continue
 
-        # check if generation exceeds capacity and update if necessary
-        if write_to_db:
-            site_uuid = asset_data["site_uuid"].iloc[0]
-            max_power = float(asset_data["power_kw"].max())  
-            
-            site = db_session.query(SiteSQL).filter(SiteSQL.site_uuid == site_uuid).first()
-            if site and max_power > site.capacity_kw:
-                log.info(
-                    f"Updating capacity for site {site_uuid} from {site.capacity_kw}kW "
-                    f"to {max_power}kW"
-                )
-                site.capacity_kw = max_power
-                db_session.commit()
-
-        # Drop asset_type column
-        asset_data = asset_data.drop("asset_type", axis=1)
-
-        if write_to_db:
-            insert_generation_values(db_session, asset_data)
-            db_session.commit()
-        else:
-            log.info(f"Generation data: {asset_type}:\n{asset_data.to_string()}")
+        if max_power > site.capacity_kw:
+            log.info(
+                "Updating capacity for site %s from %skW to %skW",
+                site.site_uuid,
+                site.capacity_kw,
+                max_power,
+            )
+            site.capacity_kw = max_power
+
+    # As in insert_generation_values, warn about duplicate times for a site. Only the first of
+    # them is written, as the rest conflict with it
+    duplicated = generation_data.duplicated(["site_uuid", "start_utc"])
+    for site_uuid in generation_data.loc[duplicated, "site_uuid"].unique():
+        log.warning('Duplicate target datetimes for site "%s"', site_uuid)
+
+    # Write all generation values. Both write paths only read the site_uuid, start_utc and
+    # power_kw columns, so there is no need to drop asset_type first
+    if len(generation_data) >= COPY_THRESHOLD:
+        copy_generation_values(db_session, generation_data)
+    else:
+        insert_generation_rows(db_session, generation_data)
+
+
+def run(db_session: Session, data_url: str, write_to_db: bool, retry_interval: int = 2) -> None:
+    """
+    Fetches the latest generation data and saves it against the RUVNL sites
+
+    Nothing is committed here; see save_generation_data.
+
+    Args:
+            db_session: A SQLAlchemy session
+            data_url: the URL to fetch generation data from
+            write_to_db: If true, generation values are written to db, otherwise to stdout
+            retry_interval: the backoff factor (seconds) for retries when fetching data
+    """
+    # 1. Get sites and 2. fetch latest generation data
+    # These are independent, so the data is fetched in the background while the sites are read
+    # (the session is only used from this thread). The fetch runs in a daemon thread so that, if
+    # getting the sites fails, the error is raised without waiting out the fetch's retries.
+    log.info("Fetching generation data from %s...", data_url)
+    data_future = Future()
+
+    def _fetch() -> None:
+        try:
+            data_future.set_result(fetch_data(data_url, retry_interval))
+        except BaseException as err:
+            data_future.set_exception(err)
+
+    threading.Thread(target=_fetch, name="fetch_data", daemon=True).start()
+
+    log.info("Getting sites...")
+    sites = get_sites(db_session)
+    log.info("Found %s sites", len(sites))
+
+    data = data_future.result()
+
+    # 3. Assign site to generation data
+    data = merge_generation_data_with_sites(data, sites)
+
+    # 3. Write generation data to DB or stdout
+    if data.empty:
+        log.warning("No generation data to write")
+    else:
+        log.info("Writing generation data...")
+        save_generation_data(db_session, data, write_to_db, sites)
+
 
 @click.command()
 @click.option(
@@ -214,17 +531,33 @@ def save_generation_data(
 )
 @click.option(
     "--retry-interval",
-    default=30,
-    help="Set the sleep time (seoncds) between retries for fetching data.",
+    default=2,
+    help="Set the backoff factor (seconds) for the exponential backoff between retries "
+    "for fetching data.",
     show_default=True,
 )
 def app(write_to_db: bool, log_level: str, retry_interval: int) -> None:
     """
     Main function for running data consumer
     """
+    from pvsite_datamodel import DatabaseConnection
+
+    # Only initialise sentry when there is somewhere to send events
+    dsn = os.getenv("SENTRY_DSN")
+    if dsn:
+        import sentry_sdk
+
+        sentry_sdk.init(
+            dsn=dsn,
+            environment=os.getenv("ENVIRONMENT", "local"),
+            traces_sample_rate=float(os.getenv("SENTRY_TRACES_SAMPLE_RATE", "0.0")),
+        )
+        sentry_sdk.set_tag("app_name", "india_ruvnl_consumer")
+        sentry_sdk.set_tag("version", __version__)
+
     logging.basicConfig(stream=sys.stdout, level=getattr(logging, log_level.upper()))
 
-    log.info(f"Running data consumer app (version: {__version__})")
+    log.info("Running data consumer app (version: %s)", __version__)
 
     url = os.getenv("DB_URL", "sqlite:///test.db")
     data_url = os.getenv("DATA_URL", DEFAULT_DATA_URL)
@@ -232,27 +565,11 @@ def app(write_to_db: bool, log_level: str, retry_interval: int) -> None:
     # 0. Initialise DB connection
     db_conn = DatabaseConnection(url, echo=False)
 
-    with db_conn.get_session() as session:
-        # 1. Get sites
-        log.info("Getting sites...")
-        sites = get_sites(session)
-        log.info(f"Found {len(sites)} sites")
-
-        # 2. Fetch latest generation data
-        log.info(f"Fetching generation data from {data_url}...")
-        data = fetch_data(data_url, retry_interval)
-
-        # 3. Assign site to generation data
-        data = merge_generation_data_with_sites(data, sites)
-
-        # 3. Write generation data to DB or stdout
-        if data.empty:
-            log.warning("No generation data to write")
-        else:
-            log.info("Writing generation data...")
-            save_generation_data(session, data, write_to_db)
+    # All reads and writes share a single transaction, committed when the block exits
+    with db_conn.get_session() as session, session.begin():
+        run(session, data_url, write_to_db, retry_interval)
 
-        log.info("Done!")
+    log.info("Done!")
 
 
 if __name__ == "__main__":
@@ -1,12 +1,39 @@
 """Testing utils."""
 
+import functools
+import json
+
 from click.testing import CliRunner
 
+from ruvnl_consumer_app.app import DEFAULT_DATA_URL
+
 
+@functools.cache
 def load_mock_response(response_file_name):
+    """Reads a mock response file, cached as the files are shared between tests."""
+
     with open(response_file_name) as f:
         return f.read()
 
+
+def serve_edited_response(
+    requests_mock, edit, response_file_name="tests/mock/responses/ruvnl-valid-response.json"
+):
+    """Mocks the RUVNL endpoint with a mock response, after passing each of its records to edit."""
+
+    raw_data = json.loads(load_mock_response(response_file_name))
+    for d in raw_data["data"]:
+        edit(d["0"])
+
+    requests_mock.get(DEFAULT_DATA_URL, text=json.dumps(raw_data))
+
+
+def cell(df, row, col):
+    """Gets a single value from a dataframe by row position and column name."""
+
+    return df.iat[row, df.columns.get_loc(col)]
+
+
 def run_click_script(func, args: list[str], catch_exceptions: bool = False):
     """Util to test click scripts while showing the stdout."""
 
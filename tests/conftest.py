@@ -7,17 +7,33 @@ import os
 
 import pandas as pd
 import pytest
-from pvsite_datamodel.sqlmodels import Base, SiteSQL
-from sqlalchemy import create_engine
+from pvsite_datamodel.sqlmodels import Base, GenerationSQL, SiteSQL
+from sqlalchemy import create_engine, event, func, insert, select
 from sqlalchemy.orm import Session
 from testcontainers.postgres import PostgresContainer
 
+from ruvnl_consumer_app.app import DEFAULT_DATA_URL
+
+from ._utils import load_mock_response
+
 
 @pytest.fixture(scope="session")
 def engine():
-    """Database engine fixture."""
+    """
+    Database engine fixture.
 
-    with PostgresContainer("postgres:14.5") as postgres:
+    This is session scoped, so under pytest-xdist each worker process gets its own database (and
+    its own DB_URL) and workers never see each other's rows.
+
+    Workers deliberately don't share one container. Whichever worker started it would own its
+    lifetime, and could stop it (or have it reaped) while other workers are still using it.
+    """
+
+    # Durability isn't needed for a throwaway test DB, so skip fsyncing on every commit
+    postgres = PostgresContainer("postgres:14.5").with_command(
+        "-c fsync=off -c synchronous_commit=off -c full_page_writes=off"
+    )
+    with postgres:
         url = postgres.get_connection_url()
         os.environ["DB_URL"] = url
         engine = create_engine(url)
@@ -25,27 +41,40 @@ def engine():
 
         yield engine
 
+        engine.dispose()
+
 
 @pytest.fixture()
 def db_session(engine):
-    """Return a sqlalchemy session, which tears down everything properly post-test."""
+    """
+    Return a sqlalchemy session, which tears down everything properly post-test.
+
+    The schema and seed data are built once per test session. Each test runs inside an outer
+    transaction on its own connection, with the session working in a SAVEPOINT which is restarted
+    whenever the code under test commits or rolls back, so nothing done through this session
+    outlives the test. Code that opens its own connection from DB_URL, like the app command in
+    test_app, is not covered: its generation values and capacity updates are committed for the
+    rest of the test session.
+    """
 
     connection = engine.connect()
-    # begin the nested transaction
+    # begin the outer transaction, which is rolled back after the test
     transaction = connection.begin()
-    # use the connection with the already started transaction
 
     with Session(bind=connection) as session:
-        yield session
+        nested = connection.begin_nested()
+
+        @event.listens_for(session, "after_transaction_end")
+        def restart_savepoint(session, trans):
+            nonlocal nested
+            if not nested.is_active:
+                nested = connection.begin_nested()
 
-        session.close()
-        # roll back the broader transaction
-        transaction.rollback()
-        # put back the connection to the connection pool
-        connection.close()
-        session.flush()
+        yield session
 
-    engine.dispose()
+    # roll back the outer transaction and put the connection back in the pool
+    transaction.rollback()
+    connection.close()
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -54,35 +83,46 @@ def db_data(engine):
 
     with engine.connect() as connection:
         with Session(bind=connection) as session:
-            # PV site
-            site = SiteSQL(
-                client_site_id=1,
+            common = dict(
                 latitude=20.59,
                 longitude=78.96,
                 capacity_kw=4,
-                ml_id=1,
-                asset_type="pv",
                 country="india",
-                region='ruvnl'
+                region="ruvnl",
             )
-            session.add(site)
-
-            # Wind site
-            site = SiteSQL(
-                client_site_id=2,
-                latitude=20.59,
-                longitude=78.96,
-                capacity_kw=4,
-                ml_id=2,
-                asset_type="wind",
-                country="india",
-                region='ruvnl'
+            session.execute(
+                insert(SiteSQL),
+                [
+                    # PV site
+                    dict(client_site_id=1, ml_id=1, asset_type="pv", **common),
+                    # Wind site
+                    dict(client_site_id=2, ml_id=2, asset_type="wind", **common),
+                ],
             )
-            session.add(site)
 
             session.commit()
 
 
+@pytest.fixture()
+def baseline_generation_count(db_session):
+    """The number of generation values in the DB before the test writes any"""
+
+    return db_session.scalar(select(func.count()).select_from(GenerationSQL))
+
+
+@pytest.fixture()
+def sites(request, db_session):
+    """
+    The seeded sites
+
+    Tests can select only some asset types by parametrizing this fixture indirectly with a list
+    of asset type names, e.g. ["wind"].
+    """
+
+    asset_types = getattr(request, "param", ["pv", "wind"])
+    return [s for s in db_session.query(SiteSQL).all() if s.asset_type.name in asset_types]
+
+
 @pytest.fixture()
 def unassociated_generation_data(db_session):
     """
@@ -110,3 +150,23 @@ def associated_generation_data(db_session):
     ]
 
     return pd.DataFrame(data, columns=["site_uuid", "start_utc", "power_kw", "asset_type"])
+
+
+@pytest.fixture()
+def ruvnl_mock(request, requests_mock):
+    """
+    Mocks the RUVNL data endpoint
+
+    Parametrize this fixture indirectly with the mock response to serve, i.e. the name of a file in
+    tests/mock/responses (e.g. "ruvnl-valid-response"), or None for a 404 response.
+    """
+
+    if request.param is None:
+        requests_mock.get(DEFAULT_DATA_URL, status_code=404, reason="Not Found")
+    else:
+        requests_mock.get(
+            DEFAULT_DATA_URL,
+            text=load_mock_response(f"tests/mock/responses/{request.param}.json"),
+        )
+
+    return requests_mock
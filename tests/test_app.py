@@ -1,29 +1,70 @@
 """
 Tests for functions in app.py
 """
+import datetime as dt
+import http.server
 import logging
+import subprocess
+import sys
+import threading
+import time
 import uuid
 
+import ijson
 import pandas as pd
 import pytest
 import requests
-from freezegun import freeze_time
 from pvsite_datamodel import GenerationSQL, SiteSQL
+from sqlalchemy import func, select
 
 from ruvnl_consumer_app.app import (
+    COPY_THRESHOLD,
     DEFAULT_DATA_URL,
+    MAX_BACKOFF,
+    MAX_RETRIES,
+    _get_http_session,
+    _get_retry,
     app,
     fetch_data,
     get_sites,
     merge_generation_data_with_sites,
+    run,
     save_generation_data,
 )
 
-from ._utils import load_mock_response, run_click_script
+from ._utils import cell, load_mock_response, run_click_script, serve_edited_response
 
 retry_interval = 0
 
 
+@pytest.fixture(autouse=True)
+def _info_logs(caplog):
+    """Capture INFO logs in every test"""
+
+    caplog.set_level(logging.INFO)
+
+
+def assert_generation_delta(db_session, baseline, expected_delta):
+    """Asserts the number of generation values in the DB has grown by expected_delta"""
+
+    count = db_session.scalar(select(func.count()).select_from(GenerationSQL))
+    assert count == baseline + expected_delta
+
+
+def test_import_is_lazy():
+    """Test that importing the app (e.g. to run --help) doesn't load the heavy dependencies"""
+
+    heavy = ["pandas", "requests", "sqlalchemy", "pvsite_datamodel", "sentry_sdk"]
+    code = (
+        "import sys, ruvnl_consumer_app.app; "
+        f"print([m for m in {heavy} if m in sys.modules])"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+
+    assert result.returncode == 0
+    assert result.stdout.strip() == "[]"
+
+
 class TestGetSites:
     """
     Test Suite for getting sites
@@ -33,14 +74,12 @@ class TestGetSites:
         """Test for getting correct sites"""
 
         sites = get_sites(db_session)
-        sites = sorted(sites, key=lambda s: s.asset_type.name)
 
         assert len(sites) == 2
         for site in sites:
             assert isinstance(site.site_uuid, uuid.UUID)
 
-        assert sites[0].asset_type.name == "pv"
-        assert sites[1].asset_type.name == "wind"
+        assert {s.asset_type.name for s in sites} == {"pv", "wind"}
 
 
 class TestFetchData:
@@ -48,14 +87,10 @@ class TestFetchData:
     Test suite for fetching data from RUVNL
     """
 
-    @freeze_time("2021-01-31T10:01:00Z")
-    def test_fetch_data(self, requests_mock):
+    @pytest.mark.parametrize("ruvnl_mock", ["ruvnl-valid-response"], indirect=True)
+    def test_fetch_data(self, ruvnl_mock):
         """Test for correctly fetching data"""
 
-        requests_mock.get(
-            DEFAULT_DATA_URL,
-            text=load_mock_response("tests/mock/responses/ruvnl-valid-response.json"),
-        )
         result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
         assert isinstance(result, pd.DataFrame)
@@ -66,67 +101,80 @@ class TestFetchData:
             assert col in result.columns
 
         # Ensure 1 pv and wind value
-        result.sort_values(by="asset_type", inplace=True)
-        assert result.iloc[0]["asset_type"] == "pv"
-        assert result.iloc[1]["asset_type"] == "wind"
+        assert set(result["asset_type"]) == {"pv", "wind"}
+        assert not result[["start_utc", "power_kw"]].isna().to_numpy().any()
 
-        for vals in result[["start_utc", "power_kw"]]:
-            assert not pd.isna(vals)
-
-    @freeze_time("2021-01-31T10:01:00Z")
-    def test_fetch_data_with_negative_power(self, requests_mock, caplog):
+    @pytest.mark.parametrize("ruvnl_mock", ["ruvnl-valid-response-negative-power"], indirect=True)
+    def test_fetch_data_with_negative_power(self, ruvnl_mock, caplog):
         """Test for fetching data with negative power values"""
 
-        requests_mock.get(
-            DEFAULT_DATA_URL,
-            text=load_mock_response("tests/mock/responses/ruvnl-valid-response-negative-power.json"),
-        )
         result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
         assert result.empty
-        assert "WARNING" in caplog.text
+        assert "No generation data for asset type: pv" in caplog.text
+        assert "No generation data for asset type: wind" in caplog.text
+
+    def test_fetch_data_drops_negative_power(self, requests_mock, caplog):
+        """Test for dropping a negative power value for one asset type"""
+
+        def make_pv_negative(record):
+            if record["scada_name"] == "SOLAR GEN":
+                record["Average2"] = -1.0
 
-    @freeze_time("2021-01-31T10:01:00Z")
-    def test_fetch_data_with_missing_asset(self, requests_mock, caplog):
+        serve_edited_response(requests_mock, make_pv_negative)
+        result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
+
+        assert result.shape[0] == 1
+        assert cell(result, 0, "asset_type") == "wind"
+        assert "Ignoring 1 negative power value(s)" in caplog.text
+        assert "Found generation data for asset type: wind" in caplog.text
+        assert "Found generation data for asset type: pv" not in caplog.text
+
+    def test_fetch_data_with_malformed_record(self, requests_mock, caplog):
+        """Test for skipping an asset record with missing fields"""
+
+        def drop_pv_power(record):
+            if record["scada_name"] == "SOLAR GEN":
+                del record["Average2"]
+
+        serve_edited_response(requests_mock, drop_pv_power)
+        result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
+
+        assert result.shape[0] == 1
+        assert cell(result, 0, "asset_type") == "wind"
+        assert "Ignoring malformed record for SOLAR GEN" in caplog.text
+        assert "No generation data for asset type: pv" in caplog.text
+
+    @pytest.mark.parametrize("ruvnl_mock", ["ruvnl-valid-response-missing-pv"], indirect=True)
+    def test_fetch_data_with_missing_asset(self, ruvnl_mock, caplog):
         """Test for fetching data with missing asset type"""
 
-        requests_mock.get(
-            DEFAULT_DATA_URL,
-            text=load_mock_response("tests/mock/responses/ruvnl-valid-response-missing-pv.json"),
-        )
         result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
         assert result.shape[0] == 1
-        assert result.iloc[0]["asset_type"] == "wind"
+        assert cell(result, 0, "asset_type") == "wind"
         assert "No generation data for asset type: pv" in caplog.text
 
-    def test_catch_bad_response_code(self, requests_mock):
+    @pytest.mark.parametrize("ruvnl_mock", [None], indirect=True)
+    def test_catch_bad_response_code(self, ruvnl_mock):
         """Test for handling bad response code by returning empty DataFrame"""
 
-        requests_mock.get(DEFAULT_DATA_URL, status_code=404, reason="Not Found")
         result = fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
         assert isinstance(result, pd.DataFrame)
         assert result.empty
 
-    def test_old_fetch_data(self, requests_mock):
+    @pytest.mark.parametrize("ruvnl_mock", ["ruvnl-valid-response"], indirect=True)
+    def test_old_fetch_data(self, ruvnl_mock):
         """Test for correctly fetching data"""
 
-        requests_mock.get(
-            DEFAULT_DATA_URL,
-            text=load_mock_response("tests/mock/responses/ruvnl-valid-response.json"),
-        )
-
         # we now just get a warning
         fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
-    def test_catch_bad_response_json(self, requests_mock):
+    @pytest.mark.parametrize("ruvnl_mock", ["ruvnl-invalid-response"], indirect=True)
+    def test_catch_bad_response_json(self, ruvnl_mock):
         """Test for catching invalid response JSON"""
 
-        requests_mock.get(
-            DEFAULT_DATA_URL,
-            text=load_mock_response("tests/mock/responses/ruvnl-invalid-response.json"),
-        )
-        with pytest.raises(requests.exceptions.JSONDecodeError):
+        with pytest.raises(ijson.JSONError):
             fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
     def test_call_bad_url(self, requests_mock):
@@ -137,14 +185,73 @@ class TestFetchData:
         with pytest.raises(RuntimeError, match=r"Failed to fetch data after \d+ attempts from.*"):
             fetch_data(DEFAULT_DATA_URL, retry_interval=retry_interval)
 
+    def test_retry_policy(self):
+        """Test that the session used to fetch data retries with exponential backoff"""
+
+        retry = _get_http_session(2).get_adapter(DEFAULT_DATA_URL).max_retries
+
+        assert retry.total == MAX_RETRIES
+        assert retry.backoff_factor == 2
+        assert set(retry.status_forcelist) == {500, 502, 503, 504}
+
+    def test_retry_backoff_jitter_and_cap(self):
+        """Test that retry waits are jittered, and capped at MAX_BACKOFF"""
+
+        # after two failed attempts the wait is 2 * backoff_factor, plus up to backoff_factor
+        retry = _get_retry(1)
+        for _ in range(2):
+            retry = retry.increment(method="GET", url=DEFAULT_DATA_URL)
+        waits = {retry.get_backoff_time() for _ in range(20)}
+        assert all(2 <= wait <= 3 for wait in waits)
+        assert len(waits) > 1
+
+        retry = _get_retry(100)
+        for _ in range(3):
+            retry = retry.increment(method="GET", url=DEFAULT_DATA_URL)
+        assert retry.get_backoff_time() == MAX_BACKOFF
+
+    def test_fetch_data_retries_server_errors(self):
+        """Test for retrying when the server responds with an error, against a real server"""
+
+        body = load_mock_response("tests/mock/responses/ruvnl-valid-response.json").encode()
+        n_requests = 0
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                nonlocal n_requests
+                n_requests += 1
+                # fail the first two requests
+                if n_requests <= 2:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        with http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler) as server:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                result = fetch_data(
+                    f"http://127.0.0.1:{server.server_port}/", retry_interval=retry_interval
+                )
+            finally:
+                server.shutdown()
+
+        assert n_requests == 3
+        assert set(result["asset_type"]) == {"pv", "wind"}
+
 
 class TestMergeGenerationDataWithSite:
     """Test suite for merging generation data with site ids"""
 
-    def test_merge_data_with_sites(self, db_session, unassociated_generation_data):
+    def test_merge_data_with_sites(self, sites, unassociated_generation_data):
         """Test for successful merge of generation data with sites"""
 
-        sites = db_session.query(SiteSQL).all()
         result = merge_generation_data_with_sites(unassociated_generation_data, sites)
 
         assert isinstance(result, pd.DataFrame)
@@ -157,48 +264,40 @@ class TestMergeGenerationDataWithSite:
         for site_uuid in result["site_uuid"]:
             assert pd.notnull(site_uuid)
 
-    def test_merge_data_with_sites_with_missing_pv_data(
-        self, db_session, unassociated_generation_data
-    ):
+    def test_merge_data_with_sites_with_missing_pv_data(self, sites, unassociated_generation_data):
         """Test for merge of generation data without pv with sites"""
 
-        sites = db_session.query(SiteSQL).all()
+        sites_by_type = {s.asset_type.name: s for s in sites}
         df = unassociated_generation_data
         data_without_pv = df.drop(df[df["asset_type"] == "pv"].index)
 
         assert data_without_pv.shape[0] == 1
-        assert data_without_pv.iloc[0]["asset_type"] == "wind"
+        assert cell(data_without_pv, 0, "asset_type") == "wind"
 
         result = merge_generation_data_with_sites(data_without_pv, sites)
 
         assert result.shape[0] == 1
-        assert result.iloc[0]["site_uuid"] == next(
-            s.site_uuid for s in sites if s.asset_type.name == "wind"
-        )
+        assert cell(result, 0, "site_uuid") == sites_by_type["wind"].site_uuid
 
-    def test_merge_data_with_sites_with_missing_pv_site(
-        self, db_session, unassociated_generation_data
-    ):
+    @pytest.mark.parametrize("sites", [["wind"]], indirect=True)
+    def test_merge_data_with_sites_with_missing_pv_site(self, sites, unassociated_generation_data):
         """Test for merge of generation data with missing pv site"""
 
-        sites = db_session.query(SiteSQL).filter(SiteSQL.asset_type == "wind")
-
+        sites_by_type = {s.asset_type.name: s for s in sites}
         result = merge_generation_data_with_sites(unassociated_generation_data, sites)
 
         assert result.shape[0] == 1
-        assert result.iloc[0]["site_uuid"] == next(
-            s.site_uuid for s in sites if s.asset_type.name == "wind"
-        )
+        assert cell(result, 0, "site_uuid") == sites_by_type["wind"].site_uuid
 
 
 @pytest.mark.parametrize("write_to_db", [True, False])
-def test_save_generation_data(write_to_db, db_session, caplog, associated_generation_data):
+def test_save_generation_data(
+    write_to_db, db_session, caplog, associated_generation_data, baseline_generation_count
+):
     """Test for saving generation data and capacity updates"""
 
-    caplog.set_level(logging.INFO)
-    
     # initial site capacity
-    site_uuid = associated_generation_data["site_uuid"].iloc[0]
+    site_uuid = associated_generation_data["site_uuid"].iat[0]
     site = db_session.query(SiteSQL).filter(SiteSQL.site_uuid == site_uuid).first()
     initial_capacity = site.capacity_kw
     
@@ -207,7 +306,7 @@ def test_save_generation_data(write_to_db, db_session, caplog, associated_genera
     save_generation_data(db_session, associated_generation_data, write_to_db)
 
     if write_to_db:
-        assert db_session.query(GenerationSQL).count() == 2
+        assert_generation_delta(db_session, baseline_generation_count, 2)
         # Check capacity was updated
         site = db_session.query(SiteSQL).filter(SiteSQL.site_uuid == site_uuid).first()
         assert site.capacity_kw == initial_capacity * 2
@@ -218,26 +317,104 @@ def test_save_generation_data(write_to_db, db_session, caplog, associated_genera
         assert site.capacity_kw == initial_capacity
 
 
-@freeze_time("2021-01-31T10:01:00Z")
-@pytest.mark.parametrize("write_to_db", [True, False])
-def test_app(write_to_db, requests_mock, db_session, caplog):
-    """Test for running app from command line"""
+def test_save_generation_data_skips_existing(
+    db_session, associated_generation_data, baseline_generation_count
+):
+    """Test for saving the same generation data twice"""
 
-    caplog.set_level(logging.INFO)
-    requests_mock.get(
-        DEFAULT_DATA_URL, text=load_mock_response("tests/mock/responses/ruvnl-valid-response.json")
+    save_generation_data(db_session, associated_generation_data, write_to_db=True)
+    save_generation_data(db_session, associated_generation_data, write_to_db=True)
+
+    assert_generation_delta(db_session, baseline_generation_count, 2)
+    for generation in db_session.query(GenerationSQL):
+        assert generation.end_utc == generation.start_utc + dt.timedelta(minutes=5)
+
+
+def test_save_generation_data_with_duplicate_times(
+    db_session, associated_generation_data, baseline_generation_count, caplog
+):
+    """Test for saving generation data with a repeated time for a site"""
+
+    data = pd.concat([associated_generation_data, associated_generation_data.iloc[[0]]])
+    save_generation_data(db_session, data, write_to_db=True)
+
+    assert "Duplicate target datetimes for site" in caplog.text
+    assert_generation_delta(db_session, baseline_generation_count, 2)
+
+
+def test_save_generation_data_with_copy(db_session, baseline_generation_count):
+    """Test for saving a large batch of generation data via COPY"""
+
+    site = db_session.query(SiteSQL).filter(SiteSQL.asset_type == "pv").first()
+    start = dt.datetime(2021, 1, 1, tzinfo=dt.UTC)
+    data = pd.DataFrame(
+        {
+            "site_uuid": site.site_uuid,
+            "start_utc": [start + dt.timedelta(minutes=5 * i) for i in range(COPY_THRESHOLD)],
+            "power_kw": 1.0,
+            "asset_type": "pv",
+        }
     )
-    init_n_generation_data = db_session.query(GenerationSQL).count()
 
-    args = [f"--retry-interval={retry_interval}"]
-    if write_to_db:
-        args.append("--write-to-db")
+    save_generation_data(db_session, data, write_to_db=True)
+    assert_generation_delta(db_session, baseline_generation_count, COPY_THRESHOLD)
 
-    result = run_click_script(app, args)
-    assert result.exit_code == 0
+    # re-saving the same batch should skip the existing rows
+    save_generation_data(db_session, data, write_to_db=True)
+    assert_generation_delta(db_session, baseline_generation_count, COPY_THRESHOLD)
+
+    generation = db_session.query(GenerationSQL).order_by(GenerationSQL.start_utc).first()
+    assert generation.start_utc == start.replace(tzinfo=None)
+    assert generation.end_utc == generation.start_utc + dt.timedelta(minutes=5)
+
+
+@pytest.mark.parametrize("ruvnl_mock", ["ruvnl-valid-response"], indirect=True)
+@pytest.mark.parametrize("write_to_db", [True, False])
+def test_run(write_to_db, ruvnl_mock, db_session, caplog, baseline_generation_count):
+    """Test for fetching and saving the latest generation data"""
+
+    run(db_session, DEFAULT_DATA_URL, write_to_db, retry_interval=retry_interval)
 
     if write_to_db:
-        assert db_session.query(GenerationSQL).count() == init_n_generation_data + 2
+        assert_generation_delta(db_session, baseline_generation_count, 2)
     else:
-        assert db_session.query(GenerationSQL).count() == init_n_generation_data
+        assert "Generation data:" in caplog.text
+        assert_generation_delta(db_session, baseline_generation_count, 0)
+
+
+def test_run_without_sites_does_not_wait_for_fetch(requests_mock, db_session):
+    """Test that a missing site is raised without waiting for the data fetch to finish"""
+
+    release = threading.Event()
+
+    def slow_response(request, context):
+        release.wait(timeout=10)
+        return load_mock_response("tests/mock/responses/ruvnl-valid-response.json")
+
+    requests_mock.get(DEFAULT_DATA_URL, text=slow_response)
+    db_session.query(SiteSQL).filter(SiteSQL.asset_type == "pv").delete()
+
+    try:
+        start = time.monotonic()
+        with pytest.raises(AssertionError, match="asset type: pv"):
+            run(db_session, DEFAULT_DATA_URL, write_to_db=False, retry_interval=retry_interval)
+        # the mocked response blocks for 10s
+        assert time.monotonic() - start < 5
+    finally:
+        release.set()
+
+
+def test_app(requests_mock, db_session, baseline_generation_count):
+    """Test for running app from command line"""
+
+    # The app commits its rows, so serve them a day later than the other tests' data to keep
+    # those tests' inserts from conflicting with them, whatever order the tests run in
+    def shift_by_a_day(record):
+        record["SourceTimeSec"] = str(int(record["SourceTimeSec"]) + 24 * 60 * 60)
+
+    serve_edited_response(requests_mock, shift_by_a_day)
+
+    result = run_click_script(app, [f"--retry-interval={retry_interval}", "--write-to-db"])
+    assert result.exit_code == 0
 
+    assert_generation_delta(db_session, baseline_generation_count, 2)